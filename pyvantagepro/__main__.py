@@ -10,6 +10,10 @@
 
 '''
 import os
+import sys
+import csv
+import mmap
+import struct
 import argparse
 
 from datetime import datetime
@@ -17,117 +21,279 @@ from datetime import datetime
 # Make sure the logger is configured early:
 from . import VERSION
 from .logger import active_logger
-from .device import VantagePro2
-from .utils import csv_to_dict
-from .compat import stdout
+from .utils import write_csv
+from .compat import to_char, fdopen_csv
 
+# number of archive records in a DMPAFT dump page
+RECORDS_PER_PAGE = 5
 
-NOW = datetime.now().strftime("%Y-%m-%d %H:%M")
+# sysfs latency timer of a Linux USB-serial adapter, by tty name
+LATENCY_TIMER_PATH = '/sys/bus/usb-serial/devices/%s/latency_timer'
+
+
+def parse_datetime(value, format="%Y-%m-%d %H:%M"):
+    '''Parse an ISO-8601 datetime string, falling back to `format` when
+    `datetime.fromisoformat` is not available or fails.'''
+    fromisoformat = getattr(datetime, 'fromisoformat', None)
+    if fromisoformat is not None:
+        try:
+            dtime = fromisoformat(value)
+        except ValueError:
+            pass
+        else:
+            # the station only knows local time
+            if dtime.tzinfo is not None:
+                raise ValueError("Timezone offsets are not supported: %s"
+                                 % value)
+            return dtime
+    return datetime.strptime(value, format)
 
 
 def gettime_cmd(args, vp):
     '''Gettime command.'''
-    print("%s - %s" % (vp.gettime(), vp.timezone))
+    if args.raw:
+        sys.stdout.write("%s\n" % vp.gettime())
+    else:
+        print("%s - %s" % (vp.gettime(), vp.timezone))
 
 
 def settime_cmd(args, vp):
     '''Settime command.'''
     old_time = vp.gettime()
-    vp.settime(datetime.strptime(args.datetime, "%Y-%m-%d %H:%M"))
-    print("Old value : %s - %s" % (old_time, vp.timezone))
-    print("New value : %s - %s" % (vp.gettime(), vp.timezone))
+    vp.settime(parse_datetime(args.datetime))
+    print("Old value : %s - %s\nNew value : %s - %s"
+          % (old_time, vp.timezone, vp.gettime(), vp.timezone))
 
 
 def getinfo_cmd(args, vp):
     '''Getinfo command.'''
-    info = "Firmware date : %s\n" % vp.firmware_date
-    info = "%sFirmware version : %s\n" % (info, vp.firmware_version)
-    info = "%sDiagnostics : %s\n" % (info, vp.diagnostics)
-    print("%s" % info)
+    info = ("Firmware date : %s" % vp.firmware_date,
+            "Firmware version : %s" % vp.firmware_version,
+            "Diagnostics : %s\n" % vp.diagnostics)
+    print("\n".join(info))
 
 
 def getdata_cmd(args, vp):
     '''Get real-time data command'''
-    args.delim = args.delim.decode("string-escape")
-    data = vp.get_current_data().to_csv(delimiter=args.delim)
-    args.output.write("%s" % data)
+    write_csv(args.output, [vp.get_current_data()], args.delim)
 
 
-def getarchives(args, vp):
-    '''Getarchive with progressbar if `args.debug` is True.'''
-    from .utils import ListDict
+def iter_archives(args, vp):
+    '''Yield new archive records with a progress bar if `args.debug` is
+    False.'''
     if args.debug:
-        return vp.get_archives(args.start, args.stop)
-    from progressbar import ProgressBar, Percentage, Bar
-    archives = ListDict()
-    dates = []
+        for record in vp.get_archives(args.start, args.stop):
+            yield record
+        return
+    from tqdm import tqdm
+    dates = set()
+    # Once the archive ring has wrapped, the first dump page starts with the
+    # newest records. The first page is held back: its records older than
+    # the next one are yielded in order, the newer ones at the end.
+    head = []
+    newest = []
     generator = vp._get_archives_generator(args.start, args.stop)
-    widgets = ['Archives download: ', Percentage(), ' ', Bar()]
-    pbar = ProgressBar(widgets=widgets, maxval=2600).start()
-    for step, record in enumerate(generator):
-        pbar.update(step)
-        if record['Datetime'] not in dates:
-            archives.append(record)
-            dates.append(record['Datetime'])
-    pbar.finish()
-    if not archives:
-        print("No new records were found﻿")
-    elif len(archives) == 1:
-        print("1 new record was found")
+    # the number of records is unknown, the bar is disabled on non-TTY
+    for record in tqdm(generator, desc='Archives download', unit=' records',
+                       disable=None):
+        if record['Datetime'] in dates:
+            continue
+        dates.add(record['Datetime'])
+        if head is not None:
+            if len(head) < RECORDS_PER_PAGE:
+                head.append(record)
+                continue
+            for held in sorted(head, key=lambda k: k['Datetime']):
+                if held['Datetime'] < record['Datetime']:
+                    yield held
+                else:
+                    newest.append(held)
+            head = None
+        yield record
+    for held in sorted((head or []) + newest, key=lambda k: k['Datetime']):
+        yield held
+
+
+def write_archives(args, vp, output, header=True):
+    '''Stream new archive records to `output` as CSV rows.'''
+    count = write_csv(output, iter_archives(args, vp), args.delim, header)
+    if count == 0:
+        sys.stderr.write("No new records were found\n")
+    elif count == 1:
+        sys.stderr.write("1 new record was found\n")
     else:
-        print("%d new records were found" % len(archives))
-    return archives.sorted_by('Datetime')
+        sys.stderr.write("%d new records were found\n" % count)
 
 
 def getarchives_cmd(args, vp):
     '''Getarchive command.'''
-    args.delim = args.delim.decode("string-escape")
     if args.start is not None:
-        args.start = datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+        args.start = parse_datetime(args.start)
     if args.stop is not None:
-        args.stop = datetime.strptime(args.stop, "%Y-%m-%d %H:%M")
-    args.output.write(getarchives(args, vp).to_csv(delimiter=args.delim))
+        args.stop = parse_datetime(args.stop)
+    write_archives(args, vp, args.output)
+
+
+def get_latest_datetime(file_db, delimiter):
+    '''Return the greatest `Datetime` value of the CSV database as string,
+    or an empty string if the database has no records.'''
+    reader = csv.DictReader(file_db, delimiter=to_char(delimiter),
+                            skipinitialspace=True)
+    if reader.fieldnames and 'Datetime' not in reader.fieldnames:
+        raise ValueError("The CSV database has no Datetime column (check "
+                         "the --delim value)")
+    latest = ''
+    # ISO-8601 datetimes can be compared as strings
+    for row in reader:
+        # skip incomplete rows, e.g. left by an interrupted update
+        if None in row or None in row.values():
+            continue
+        if row['Datetime'] > latest:
+            latest = row['Datetime']
+    return latest
+
+
+def get_tail_datetime(file_db, delimiter):
+    '''Return the `Datetime` value of the last CSV database record, read
+    from the end of the file. Returns an empty string if the database has
+    no records, or None if the tail can not be trusted and the whole
+    database must be scanned.'''
+    size = os.fstat(file_db.fileno()).st_size
+    if size == 0:
+        return ''
+    data = mmap.mmap(file_db.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        end = size
+        while end > 0 and data[end - 1:end] in (b'\r', b'\n'):
+            end -= 1
+        tail = data[data.rfind(b'\n', 0, end) + 1:end].decode('utf-8')
+    finally:
+        data.close()
+    file_db.seek(0)
+    head = file_db.readline()
+    first = file_db.readline()
+    if not first.strip():
+        # no records, only the header line
+        return '' if head.strip() == tail.strip() else None
+    rows = list(csv.reader([head, first, tail], skipinitialspace=True,
+                           delimiter=to_char(delimiter)))
+    if len(rows) != 3 or 'Datetime' not in rows[0]:
+        return None
+    fields, first, last = rows
+    if not len(fields) == len(first) == len(last):
+        return None
+    index = fields.index('Datetime')
+    # records are expected to be appended chronologically
+    if first[index] > last[index]:
+        return None
+    return last[index]
 
 
 def update_cmd(args, vp):
     '''Update command.'''
     # create file if not exist
-    with file(args.db, 'a'):
-        os.utime(args.db, None)
-    with open(args.db, 'r+a') as file_db:
-        db = csv_to_dict(file_db, delimiter=args.delim)
+    fd = os.open(args.db, os.O_RDWR | os.O_CREAT, 0o644)
+    with fdopen_csv(fd) as file_db:
+        latest = get_tail_datetime(file_db, args.delim)
+        if latest is None:
+            file_db.seek(0)
+            latest = get_latest_datetime(file_db, args.delim)
         args.start = None
         args.stop = None
-        if len(db) > 0:
-            db = db.sorted_by("Datetime", reverse=True)
-            format = "%Y-%m-%d %H:%M:%S"
-            start_date = datetime.strptime(db[0]['Datetime'], format)
-            args.start = start_date
-            items = getarchives(args, vp)
-            file_db.write(items.to_csv(delimiter=args.delim, header=False))
-        else:
-            file_db.write(getarchives(args, vp).to_csv(delimiter=args.delim))
-        file_db.close()
-
-
-def get_cmd_parser(cmd, subparsers, help, func):
+        if latest:
+            args.start = parse_datetime(latest, "%Y-%m-%d %H:%M:%S")
+        file_db.seek(0, os.SEEK_END)
+        # the header is only written in a new database
+        write_archives(args, vp, file_db, header=not latest)
+
+
+def _delim(value):
+    '''Decode backslash escapes of the CSV delimiter (e.g. "\\t").'''
+    delimiter = value.encode('utf-8').decode('unicode_escape')
+    if len(delimiter) != 1:
+        raise argparse.ArgumentTypeError("the delimiter must be a single "
+                                         "character, not %r" % value)
+    return delimiter
+
+
+# Arguments are described as (name or flags, add_argument keywords),
+# "{now}" in a help text is replaced with an example of datetime value
+COMMON_ARGUMENTS = (
+    (('--timeout',), dict(default=10.0, type=float,
+                          help="Connection link timeout")),
+    (('--debug',), dict(action="store_true", default=False,
+                        help='Display log')),
+    (('--low-latency',), dict(action="store_true", default=False,
+                              help='Set the USB-serial adapter latency timer '
+                                   'to 1 ms (Linux only)')),
+    (('url',), dict(action="store",
+                    help="Specifiy URL for connection link. "
+                         "E.g. tcp:iphost:port "
+                         "or serial:/dev/ttyUSB0:19200:8N1")),
+)
+
+OUTPUT_ARGUMENT = (('--output',), dict(action="store", default=sys.stdout,
+                                       type=argparse.FileType('w'),
+                                       help='Filename where output is '
+                                            'written'))
+
+DELIM_ARGUMENT = (('--delim',), dict(action="store", default=",",
+                                     type=_delim,
+                                     help='CSV char delimiter'))
+
+# Commands are described as (name, help, function, extra arguments)
+COMMANDS = (
+    ('gettime', 'Print the current datetime of the station.',
+     gettime_cmd, (
+         (('--raw',), dict(action="store_true", default=False,
+                           help='Print only the datetime value, without '
+                                'the timezone')),
+     )),
+    ('settime', 'Set the given datetime argument on the station.',
+     settime_cmd, (
+         (('datetime',), dict(help='The chosen datetime value. '
+                                   '(like : "{now}")')),
+     )),
+    ('getinfo', 'Print VantagePro 2 information.',
+     getinfo_cmd, ()),
+    ('getarchives', 'Extract archives data from the station between start '
+                    'datetime and stop datetime.By default the entire '
+                    'contents of the data archive will be downloaded.',
+     getarchives_cmd, (
+         OUTPUT_ARGUMENT,
+         (('--start',), dict(help='The beginning datetime record '
+                                  '(like : "{now}")')),
+         (('--stop',), dict(help='The stopping datetime record '
+                                 '(like : "{now}")')),
+         DELIM_ARGUMENT,
+     )),
+    ('getdata', 'Extract real-time data from the station.',
+     getdata_cmd, (
+         OUTPUT_ARGUMENT,
+         DELIM_ARGUMENT,
+     )),
+    ('update', 'Update CSV database records with getting automatically new '
+               'archive records.',
+     update_cmd, (
+         DELIM_ARGUMENT,
+         (('db',), dict(action="store", help='The CSV file database')),
+     )),
+)
+
+
+def get_cmd_parser(cmd, subparsers, help, func, arguments=(), now=''):
     '''Make a subparser command.'''
     parser = subparsers.add_parser(cmd, help=help, description=help)
-    parser.add_argument('--timeout', default=10.0, type=float,
-                        help="Connection link timeout")
-    parser.add_argument('--debug', action="store_true", default=False,
-                        help='Display log')
-    parser.add_argument('url', action="store",
-                        help="Specifiy URL for connection link. "
-                             "E.g. tcp:iphost:port "
-                             "or serial:/dev/ttyUSB0:19200:8N1")
+    for flags, kwargs in COMMON_ARGUMENTS + tuple(arguments):
+        if 'help' in kwargs:
+            kwargs = dict(kwargs, help=kwargs['help'].format(now=now))
+        parser.add_argument(*flags, **kwargs)
     parser.set_defaults(func=func)
     return parser
 
 
-def main():
-    '''Parse command-line arguments and execute VP2 command.'''
-
+def get_parser():
+    '''Make the command-line arguments parser.'''
     parser = argparse.ArgumentParser(prog='pyvantagepro',
                                      description='VantagePro 2 communication'
                                                  ' tools')
@@ -136,64 +302,46 @@ def main():
                         help='Print PyVantagePro’s version number and exit.')
 
     subparsers = parser.add_subparsers(title='The PyVantagePro commands')
-    # gettime command
-    subparser = get_cmd_parser('gettime', subparsers,
-                               help='Print the current datetime of the'
-                                    ' station.',
-                               func=gettime_cmd)
-
-    # settime command
-    subparser = get_cmd_parser('settime', subparsers,
-                               help='Set the given datetime argument on the'
-                                    ' station.',
-                               func=settime_cmd)
-    subparser.add_argument('datetime', help='The chosen datetime value. '
-                                            '(like : "%s")' % NOW)
-
-    # getinfo command
-    subparser = get_cmd_parser('getinfo', subparsers,
-                               help='Print VantagePro 2 information.',
-                               func=getinfo_cmd)
-
-    # getarchives command
-    subparser = get_cmd_parser('getarchives', subparsers,
-                               help='Extract archives data from the station '
-                                    'between start datetime and stop datetime.'
-                                    'By default the entire contents of the '
-                                    'data archive will be downloaded.',
-                               func=getarchives_cmd)
-    subparser.add_argument('--output', action='store', default=stdout,
-                           type=argparse.FileType('w', 0),
-                           help='Filename where output is written')
-    subparser.add_argument('--start', help='The beginning datetime record '
-                                           '(like : "%s")' % NOW)
-    subparser.add_argument('--stop', help='The stopping datetime record '
-                                          '(like : "%s")' % NOW)
-    subparser.add_argument('--delim', action='store', default=",",
-                           help='CSV char delimiter')
-
-    # getdata command
-    subparser = get_cmd_parser('getdata', subparsers,
-                               help='Extract real-time data from the station.',
-                               func=getdata_cmd)
-    subparser.add_argument('--output', action="store", default=stdout,
-                           type=argparse.FileType('w', 0),
-                           help='Filename where output is written')
-    subparser.add_argument('--delim', action="store", default=",",
-                           help='CSV char delimiter')
-
-    # update command
-    subparser = get_cmd_parser('update', subparsers,
-                               help='Update CSV database records with getting '
-                                    'automatically new archive records.',
-                               func=update_cmd)
-    subparser.add_argument('--delim', action="store", default=",",
-                           help='CSV char delimiter')
-    subparser.add_argument('db', action="store", help='The CSV file database')
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    for cmd, help, func, arguments in COMMANDS:
+        get_cmd_parser(cmd, subparsers, help, func, arguments, now)
+    return parser
+
+
+def set_low_latency(url):
+    '''Set the latency timer of a Linux USB-serial adapter to 1 ms, so
+    that each request/response cycle does not wait for the default 16 ms
+    USB poll interval.'''
+    if not url.startswith('serial:') or not sys.platform.startswith('linux'):
+        return
+    # resolve symlinks like /dev/serial/by-id/... to the ttyUSBx device
+    tty = os.path.basename(os.path.realpath(url.split(':')[1]))
+    path = LATENCY_TIMER_PATH % tty
+    try:
+        with open(path, 'w') as latency_timer:
+            latency_timer.write('1')
+    except (IOError, OSError) as e:
+        sys.stderr.write("Warning: can not set low latency on %s: %s\n"
+                         % (tty, e))
+
+
+def main():
+    '''Parse command-line arguments and execute VP2 command.'''
+    parser = get_parser()
 
     # Parse argv arguments
     args = parser.parse_args()
 
+    from .device import (VantagePro2, NoDeviceException, BadAckException,
+                         BadCRCException, BadDataException)
+    # link, device and user input errors, programming errors are not hidden
+    errors = (IOError, OSError, ValueError, struct.error, NotImplementedError,
+              NoDeviceException, BadAckException, BadCRCException,
+              BadDataException)
+
+    if args.low_latency:
+        set_low_latency(args.url)
+
     if args.debug:
         active_logger()
         vp = VantagePro2.from_url(args.url, args.timeout)
@@ -202,7 +350,7 @@ def main():
         try:
             vp = VantagePro2.from_url(args.url, args.timeout)
             args.func(args, vp)
-        except Exception as e:
+        except errors as e:
             parser.error('%s' % e)
 
 
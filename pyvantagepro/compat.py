@@ -10,6 +10,7 @@
 
 """
 
+import os
 import sys
 
 # -------
@@ -70,6 +71,10 @@ if is_py2:
             return bytes('')
         return bytes(string[0])
 
+    def fdopen_csv(fd):
+        # the csv module needs binary files
+        return os.fdopen(fd, 'r+b')
+
     bytes = str
     str = unicode
     stdout = sys.stdout
@@ -86,6 +91,10 @@ elif is_py3:
             return str('')
         return str(string[0])
 
+    def fdopen_csv(fd):
+        # the csv module handles newlines itself
+        return os.fdopen(fd, 'r+', newline='')
+
     str = str
     bytes = bytes
     stdout = sys.stdout.buffer
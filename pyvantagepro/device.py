@@ -191,11 +191,11 @@ class VantagePro2(object):
         '''
         generator = self._get_archives_generator(start_date, stop_date)
         archives = ListDict()
-        dates = []
+        dates = set()
         for item in generator:
             if item['Datetime'] not in dates:
                 archives.append(item)
-                dates.append(item['Datetime'])
+                dates.add(item['Datetime'])
         return archives.sorted_by('Datetime')
 
     def _get_archives_generator(self, start_date=None, stop_date=None):
@@ -0,0 +1,228 @@
+# coding: utf8
+'''
+    pyvantagepro.tests.test_main
+    ----------------------------
+
+    The pyvantagepro test suite.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+
+from __future__ import unicode_literals
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+import pytest
+
+from .. import __main__
+from ..__main__ import (iter_archives, get_latest_datetime,
+                        get_tail_datetime, parse_datetime, update_cmd,
+                        set_low_latency, _delim)
+from ..utils import Dict, ListDict
+from ..compat import StringIO
+
+
+class FakeVantagePro2(object):
+    '''Station returning the given archive records.'''
+
+    def __init__(self, records):
+        self.records = records
+
+    def _get_archives_generator(self, start_date=None, stop_date=None):
+        for record in self.records:
+            if start_date is not None and record['Datetime'] <= start_date:
+                continue
+            if stop_date is not None and record['Datetime'] > stop_date:
+                continue
+            yield record
+
+    def get_archives(self, start_date=None, stop_date=None):
+        archives = ListDict(self._get_archives_generator())
+        return archives.sorted_by('Datetime')
+
+
+def make_records(count):
+    '''Returns `count` chronological archive records.'''
+    records = []
+    for i in range(count):
+        record = Dict()
+        record['Datetime'] = datetime(2012, 6, 8) + timedelta(minutes=5 * i)
+        record['TempOut'] = i
+        records.append(record)
+    return records
+
+
+def get_dates(debug, records):
+    '''Returns the datetimes of records yielded by iter_archives.'''
+    args = argparse.Namespace(debug=debug, start=None, stop=None)
+    vp = FakeVantagePro2(records)
+    return [r['Datetime'] for r in iter_archives(args, vp)]
+
+
+def test_iter_archives():
+    '''Tests iter_archives in chronological order.'''
+    records = make_records(20)
+    expected = [r['Datetime'] for r in records]
+    assert get_dates(False, records) == expected
+    assert get_dates(False, records[:3]) == expected[:3]
+    assert get_dates(False, []) == []
+
+
+def test_iter_archives_wrapped_ring():
+    '''Tests iter_archives when the archive ring has wrapped.'''
+    records = make_records(20)
+    expected = [r['Datetime'] for r in records]
+    # the first page starts with the newest records
+    for newest in range(1, 5):
+        wrapped = records[-newest:] + records[:-newest]
+        assert get_dates(False, wrapped) == expected
+        assert get_dates(True, wrapped) == expected
+
+
+def test_iter_archives_duplicates():
+    '''Tests iter_archives removes duplicate records.'''
+    records = make_records(20)
+    expected = [r['Datetime'] for r in records]
+    wrapped = records[-2:] + records[:-2] + records[-2:]
+    assert get_dates(False, wrapped) == expected
+    assert get_dates(False, records + records[:1]) == expected
+
+
+def test_parse_datetime():
+    '''Tests datetime arguments parsing.'''
+    expected = datetime(2012, 6, 12, 17, 32)
+    assert parse_datetime("2012-06-12 17:32") == expected
+    if hasattr(datetime, 'fromisoformat'):
+        assert parse_datetime("2012-06-12T17:32") == expected
+    assert parse_datetime("2012-06-12 17:32:00", "%Y-%m-%d %H:%M:%S") == \
+        expected
+    for value in ("2012-06-12T17:32+02:00", "12/06/2012 17:32"):
+        with pytest.raises(ValueError):
+            parse_datetime(value)
+
+
+def test_delim():
+    '''Tests --delim argument conversion.'''
+    assert _delim(",") == ","
+    assert _delim("\\t") == "\t"
+    for value in ("", ",,"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            _delim(value)
+
+
+def test_get_latest_datetime_without_datetime_column():
+    '''Tests database without Datetime column or with a wrong delimiter.'''
+    with pytest.raises(ValueError):
+        get_latest_datetime(StringIO("Date,T\r\n2012,1\r\n"), ",")
+    with pytest.raises(ValueError):
+        get_latest_datetime(StringIO("Datetime,T\r\n2012,1\r\n"), ";")
+
+
+def get_db_datetimes(path):
+    '''Returns tail and full scan datetimes of the database `path`.'''
+    with open(path, 'r') as file_db:
+        tail = get_tail_datetime(file_db, ",")
+        file_db.seek(0)
+        return tail, get_latest_datetime(file_db, ",")
+
+
+def write_db(tmpdir, content):
+    '''Write a temporary CSV database and returns its path.'''
+    path = str(tmpdir.join('db.csv'))
+    with open(path, 'wb') as file_db:
+        file_db.write(content.encode('utf-8'))
+    return path
+
+
+def test_get_db_datetime_file():
+    '''Tests database datetimes with file archives.'''
+    path = os.path.join('pyvantagepro', 'tests', 'ressources', 'archives.csv')
+    path = os.path.abspath(os.path.join('.', path))
+    assert get_db_datetimes(path) == ("2012-06-08 16:40:00",
+                                      "2012-06-08 16:40:00")
+
+
+def test_get_db_datetime_empty_file():
+    '''Tests database datetimes with empty file archives.'''
+    path = os.path.join('pyvantagepro', 'tests', 'ressources', 'empty.csv')
+    path = os.path.abspath(os.path.join('.', path))
+    assert get_db_datetimes(path) == ('', '')
+
+
+def test_get_db_datetime(tmpdir):
+    '''Tests database datetimes with small databases.'''
+    header = "Datetime,TempOut\r\n"
+    row1 = "2012-06-08 16:30:00,71.5\r\n"
+    row2 = "2012-06-08 16:35:00,71.6\r\n"
+    # new database
+    assert get_db_datetimes(write_db(tmpdir, "")) == ('', '')
+    assert get_db_datetimes(write_db(tmpdir, header)) == ('', '')
+    # the tail is trusted
+    expected = ("2012-06-08 16:35:00", "2012-06-08 16:35:00")
+    path = write_db(tmpdir, header + row1 + row2)
+    assert get_db_datetimes(path) == expected
+    path = write_db(tmpdir, header + row1 + row2 + "\r\n\r\n")
+    assert get_db_datetimes(path) == expected
+    path = write_db(tmpdir, header + row1 + row2.rstrip())
+    assert get_db_datetimes(path) == expected
+    # the tail can not be trusted, the whole database is scanned
+    path = write_db(tmpdir, header + row2 + row1)
+    assert get_db_datetimes(path) == (None, "2012-06-08 16:35:00")
+    path = write_db(tmpdir, header + row1 + row2 + "2012-06-08 16:4")
+    assert get_db_datetimes(path) == (None, "2012-06-08 16:35:00")
+    path = write_db(tmpdir, header + row1 + '2012-06-08 16:35:00,"a\r\nb"')
+    assert get_db_datetimes(path) == (None, "2012-06-08 16:35:00")
+
+
+def test_update_cmd(tmpdir):
+    '''Tests update command twice on the same database.'''
+    path = str(tmpdir.join('database.csv'))
+    records = make_records(15)
+    for count in (10, 15, 15):
+        args = argparse.Namespace(debug=False, delim=",", db=path)
+        update_cmd(args, FakeVantagePro2(records[:count]))
+    with open(path, 'rb') as file_db:
+        lines = file_db.read().decode('utf-8').split("\r\n")
+    assert lines[0] == "Datetime,TempOut"
+    assert lines[-1] == ""
+    rows = lines[1:-1]
+    assert rows == ["%s,%d" % (r['Datetime'], r['TempOut']) for r in records]
+
+
+def test_set_low_latency(tmpdir, monkeypatch):
+    '''Tests low latency on a Linux USB-serial adapter.'''
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    monkeypatch.setattr(__main__, 'LATENCY_TIMER_PATH',
+                        os.path.join(str(tmpdir), '%s', 'latency_timer'))
+    latency_timer = tmpdir.mkdir('ttyUSB0').join('latency_timer')
+    latency_timer.write('16')
+    set_low_latency('serial:/dev/ttyUSB0:19200:8N1')
+    assert latency_timer.read() == '1'
+
+
+def test_set_low_latency_skipped(tmpdir, monkeypatch):
+    '''Tests low latency is skipped for TCP links and other platforms.'''
+    monkeypatch.setattr(__main__, 'LATENCY_TIMER_PATH',
+                        os.path.join(str(tmpdir), '%s', 'latency_timer'))
+    latency_timer = tmpdir.mkdir('ttyUSB0').join('latency_timer')
+    latency_timer.write('16')
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    set_low_latency('tcp:192.168.0.18:1111')
+    assert latency_timer.read() == '16'
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    set_low_latency('serial:/dev/ttyUSB0:19200:8N1')
+    assert latency_timer.read() == '16'
+
+
+def test_set_low_latency_error(tmpdir, monkeypatch, capsys):
+    '''Tests low latency prints a warning when the timer can't be set.'''
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    monkeypatch.setattr(__main__, 'LATENCY_TIMER_PATH',
+                        os.path.join(str(tmpdir), '%s', 'latency_timer'))
+    set_low_latency('serial:/dev/ttyUSB0:19200:8N1')
+    out, err = capsys.readouterr()
+    assert err.startswith("Warning: can not set low latency on ttyUSB0")
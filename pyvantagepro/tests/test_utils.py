@@ -14,9 +14,10 @@ from __future__ import unicode_literals
 import os
 import random
 
-from ..utils import (cached_property, retry, Dict, hex_to_bytes,
+from ..utils import (cached_property, retry, Dict, ListDict, hex_to_bytes,
                      bytes_to_hex, bytes_to_binary, hex_to_binary,
-                     binary_to_int, csv_to_dict, is_text, is_bytes)
+                     binary_to_int, csv_to_dict, write_csv, is_text,
+                     is_bytes)
 from ..compat import StringIO
 
 
@@ -57,6 +58,22 @@ def test_csv_to_dict_empty_file():
     assert len(items) == 0
 
 
+def test_write_csv():
+    '''Tests write csv rows to stream.'''
+    d = Dict()
+    d["a"] = "111"
+    d["f"] = "222"
+    output = StringIO()
+    assert write_csv(output, iter([d, d]), delimiter=";") == 2
+    assert output.getvalue() == "a;f\r\n111;222\r\n111;222\r\n"
+    output = StringIO()
+    assert write_csv(output, [d], header=False) == 1
+    assert output.getvalue() == "111,222\r\n"
+    output = StringIO()
+    assert write_csv(output, []) == 0
+    assert output.getvalue() == ""
+
+
 def test_dict():
     '''Tests DataDict.'''
     d = Dict()
@@ -79,6 +96,21 @@ def test_ordered_dict():
     assert "f,a,b\r\n222,111,000\r\n" == d.to_csv()
 
 
+def test_list_dict_to_csv():
+    '''Tests ListDict to csv.'''
+    d1 = Dict()
+    d1["a"] = "1,5"
+    d1["b"] = 'say "hi"'
+    d2 = Dict()
+    d2["a"] = "2"
+    d2["b"] = "3"
+    items = ListDict([d1, d2])
+    assert items.to_csv() == 'a,b\r\n"1,5","say ""hi"""\r\n2,3\r\n'
+    assert items.to_csv(delimiter=";", header=False) == \
+        '1,5;"say ""hi"""\r\n2;3\r\n'
+    assert ListDict().to_csv() == ""
+
+
 class TestCachedProperty:
     ''' Tests cached_property decorator.'''
 
@@ -177,23 +177,31 @@ def csv_to_dict(file_input, delimiter=','):
     return ListDict(table)
 
 
+def write_csv(stream, items, delimiter=',', header=True):
+    '''Serialize an iterable of dictionaries to csv, writing each row
+    directly to `stream`. Returns the number of written rows.'''
+    delimiter = to_char(delimiter)
+    csvwriter = None
+    count = 0
+    for item in items:
+        if csvwriter is None:
+            fieldnames = list(item.keys())
+            csvwriter = csv.DictWriter(stream, fieldnames=fieldnames,
+                                       delimiter=delimiter)
+            if header:
+                # writeheader is not supported in python2.6
+                csvwriter.writerow(dict((key, key) for key in fieldnames))
+        csvwriter.writerow(item)
+        count += 1
+    return count
+
+
 def dict_to_csv(items, delimiter, header):
     '''Serialize list of dictionaries to csv.'''
-    content = ""
-    if len(items) > 0:
-        delimiter = to_char(delimiter)
-        output = StringIO()
-        csvwriter = csv.DictWriter(output, fieldnames=items[0].keys(),
-                                   delimiter=delimiter)
-        if header:
-            csvwriter.writerow(dict((key, key) for key in items[0].keys()))
-            # writeheader is not supported in python2.6
-            # csvwriter.writeheader()
-        for item in items:
-            csvwriter.writerow(dict(item))
-
-        content = output.getvalue()
-        output.close()
+    output = StringIO()
+    write_csv(output, items, delimiter, header)
+    content = output.getvalue()
+    output.close()
     return content
 
 
@@ -224,7 +232,7 @@ class ListDict(list):
 
     def to_csv(self, delimiter=',', header=True):
         '''Serialize list of dictionaries to csv.'''
-        return dict_to_csv(list(self), delimiter, header)
+        return dict_to_csv(self, delimiter, header)
 
     def filter(self, keys):
         '''Create a list of dictionaries with only the following `keys`.
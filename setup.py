@@ -26,7 +26,7 @@ except:
 
 REQUIREMENTS = [
     'pylink',
-    'progressbar-latest',
+    'tqdm',
 ]
 
 if sys.version_info < (2, 7):